@@ -1,92 +1,518 @@
-from misc import memoization, timer
+from misc import memoization, timer, PersistentCache, DEFAULT_CACHE_SIZE
+from encoding import Encoding
+from oracle import get_oracle
+from models import get_tree_backend
+from parallel import parallel_x_resp, supports_parallel_search
+from grid import DenseGrid
+from sampling import Estimate, monte_carlo, difference
+from coalitions import coalition_sizes, coalition_players, group_shapley_values, shapley_interactions
 
-from math import factorial
-from itertools import combinations, product
-from pandas import DataFrame
+from math import factorial, sqrt, comb
+from hashlib import sha256
+from pickle import dumps
+from time import perf_counter
+from collections import namedtuple
+from itertools import combinations
+from statistics import NormalDist
+from numpy import arange, array, ones, zeros, flatnonzero, repeat, tile, where, int64, unique, nan, isnan
+from numpy.linalg import pinv
+from numpy.random import default_rng
+from pandas import Series, DataFrame
+
+
+
+Responsibility = namedtuple('Responsibility', ['score', 'counter', 'optimal', 'evaluations'])
 
 
 
 class Explainer:
-    def __init__(self, classifier, preparer, distribution, domains=None):
+    def __init__(self, classifier, preparer, distribution, domains, cache_size=DEFAULT_CACHE_SIZE, cache_bytes=None,
+                 sampling_threshold=10**6, sampling_tolerance=0.01, sampling_confidence=0.95, sampling_budget=100000, seed=None,
+                 shapley_mode='exact', shapley_tolerance=0.01, shapley_budget=2000, dense_grid_limit=10**6, memory_budget=2**28,
+                 responsibility_mode='exact', beam_width=3, responsibility_deadline=None, responsibility_budget=None, model_engine=True,
+                 tree_engine=None, responsibility_workers=1, persistent_cache=None):
         self.predict = classifier.predict
         self.preprocess = preparer.preprocess
+        self.classes = getattr(classifier, 'classes_', None)
         self.domains = domains
         self.distribution = distribution
+        self.encoding = Encoding(domains)
+        self.weights = distribution.compile(self.encoding) if hasattr(distribution, 'compile') else None
+        self.oracle = get_oracle(classifier, preparer, self.encoding, model_engine=model_engine)
+        self.cache_limits = {'max_size': cache_size, 'max_bytes': cache_bytes}
+        self.sample = getattr(self.weights, 'sample', None)
+        self.support = getattr(self.weights, 'support', None)
+        self.sampling_threshold = sampling_threshold
+        self.sampling = {'tolerance': sampling_tolerance, 'confidence': sampling_confidence, 'budget': sampling_budget}
+        self.rng = default_rng(seed)
+        self.shapley_mode = shapley_mode
+        self.shapley_sampling = {'tolerance': shapley_tolerance, 'confidence': sampling_confidence, 'budget': shapley_budget}
+        self.caches = {}
+        self.tree_backend = get_tree_backend(classifier, preparer, self.encoding, tree_engine) if tree_engine is not None and hasattr(self.weights, 'factors') else None
+        self.responsibility_mode = responsibility_mode
+        self.beam_width = beam_width
+        self.responsibility_deadline = responsibility_deadline
+        self.responsibility_budget = responsibility_budget
+        self.responsibility_workers = responsibility_workers
+        self.expectation_table = None
+        self.parallel_search = None
+        self.chunk_size = max(1, memory_budget // self.encoding.row_bytes())
+        self.dense_grid = None
+        self.use_dense_grid = dense_grid_limit is not None and DenseGrid.supports(self.weights) and self.encoding.grid_size(()) <= dense_grid_limit
+        # the persisted keys are integer columns, so the projections and the fixed-feature bitmasks have to fit in int64
+        persistable = persistent_cache is not None and hasattr(self.weights, 'fingerprint') and self.encoding.strides.dtype == int64 and len(self.encoding.features) < 63
+        self.persistent_cache = PersistentCache(persistent_cache, self.fingerprint(classifier, preparer, tree_engine), self.encoding.features, max_size=cache_size) if persistable else None
+
+
+    def fingerprint(self, classifier, preparer, tree_engine):
+        # everything an expected value depends on: the model, the preprocessing, the domains, the distribution and the path
+        digest = sha256(dumps(classifier))
+        digest.update(dumps(preparer))
+        digest.update(repr((self.encoding.signature, self.weights.fingerprint, self.use_dense_grid, self.tree_backend is not None and tree_engine)).encode())
+        return digest.hexdigest()
+
+
+
+    def close(self):
+        if self.parallel_search is not None:
+            self.parallel_search.close()
+            self.parallel_search = None
+
+
+    def predict_codes(self, codes):
+        return self.oracle(codes)
 
 
+    def weigh(self, codes, fixed_features):
+        # a distribution weighs whole blocks of coded rows through the function its compile(encoding) returns,
+        # a plain callable such as a user-supplied distribution is still asked one labelled row at a time
+        if self.weights is not None:
+            return self.weights(codes, fixed_features)
+        pe = self.encoding.decode(codes)
+        return pe.apply(lambda e: self.distribution(e, fixed_features), axis=1).to_numpy()
 
-    def partial_entity(self, entity, fixed_features):
-        return DataFrame(product(*[[entity[feature]] if feature in fixed_features else self.domains[feature] for feature in entity.index]), columns=entity.index)
+
+    def cache_statistics(self):
+        statistics = {name: cache.statistics() for name, cache in self.caches.items()}
+        if self.persistent_cache is not None:
+            statistics['persistent'] = self.persistent_cache.statistics()
+        return statistics
 
 
-    @memoization(key_parameter={"self", "entity"})
     def prediction(self, entity):
-        return self.predict(self.preprocess(entity))[0]
+        return self.predict_codes(self.encoding.encode(entity)[None])[0]
+
+
+    def expected_prediction(self, entity, fixed_features=frozenset()):
+        entity = self.encoding.encode(entity)
+        expected_value = self.projected_expectation(entity, fixed_features)
+        if expected_value is None:
+            return self.prediction(entity)
+        return expected_value
 
 
-    @memoization(key_parameter={"self", "entity", "fixed_features"})
-    def expected_prediction(self, entity, fixed_features={}):
-        pe = self.partial_entity(entity, fixed_features)
-        weight_distribution = pe.apply(lambda e: self.distribution(e, fixed_features), axis=1)
-        total_weight = weight_distribution.sum()
-        weighted_sum = (self.predict(self.preprocess(pe)) * weight_distribution).sum()
+    @memoization(key=lambda self, entity, fixed_features: self.encoding.projection_key(entity, fixed_features), persistent=True)
+    def projected_expectation(self, entity, fixed_features):
+        if self.tree_backend is not None:
+            return self.tree_backend.expectation(entity, fixed_features, self.weights.factors)
+        if self.use_dense_grid:
+            if self.dense_grid is None:
+                self.dense_grid = DenseGrid(self.encoding, self.oracle, self.weights)
+            return self.dense_grid.expectation(entity, fixed_features)
+        if self.support is not None:
+            chunks = [self.support(entity, fixed_features)]
+        elif self.sample is not None and self.sampling_threshold is not None and self.encoding.grid_size(fixed_features) > self.sampling_threshold:
+            return self.sampled_expectation(entity, fixed_features)
+        else:
+            chunks = ((pe, self.weigh(pe, fixed_features)) for pe in self.encoding.grid_chunks(entity, fixed_features, self.chunk_size))
+
+        total_weight, weighted_sum = 0, 0
+        for pe, weight_distribution in chunks:
+            chunk_weight = weight_distribution.sum()
+            if chunk_weight != 0:
+                total_weight += chunk_weight
+                weighted_sum += (self.predict_codes(pe) * weight_distribution).sum()
 
         if total_weight == 0:
-            return self.prediction(entity)
+            return None
 
         expected_value = weighted_sum / total_weight
         return expected_value
 
 
+    def sampled_expectation(self, entity, fixed_features):
+        draw = lambda size: self.sample(entity, fixed_features, size, self.rng)
+        return monte_carlo(draw, self.predict_codes, **self.sampling)
+
+
     def counter(self, entity, feature):
-        return self.prediction(entity) - self.expected_prediction(entity, set(entity.index)-{feature})
+        return self.counter_plus(entity, {feature})
 
 
     def counter_plus(self, entity, features):
-        return self.prediction(entity) - self.expected_prediction(entity, set(entity.index)-set(features))
+        entity = self.encoding.encode(entity)
+        self.oracle.submit(entity[None])
+        expected_value = self.expected_prediction(entity, set(self.encoding.features)-set(features))
+        return difference(self.prediction(entity), expected_value)
 
 
     def x_resp(self, entity, feature, max_size=None, get_counter=True):
+        # the searches keep their Responsibility, whose optimal flag tells whether the score is proven
+        if self.responsibility_mode in ('greedy', 'beam'):
+            result = self.x_resp_search(entity, feature, max_size)
+            return result if get_counter else result.score
+        if self.responsibility_mode != 'exact':
+            raise Exception('Responsibility mode not defined.')
+        if self.responsibility_workers > 1 and supports_parallel_search(self.encoding):
+            x_resp_score, best_counter = parallel_x_resp(self, entity, feature, max_size, self.responsibility_workers)
+            return (x_resp_score, best_counter) if get_counter else x_resp_score
+
+        entity = self.encoding.encode(entity)
         entity_prediction = self.prediction(entity)
+        highest_counter = self.highest_counter(entity_prediction)
 
-        candidates = list(set(entity.index)-{feature})
+        candidates = list(set(self.encoding.features)-{feature})
         max_size = len(candidates) if max_size is None else max_size-1
         best_counter = 0
         for size in range(max_size+1):
             for contingency_set in combinations(candidates, size):
-                entities = self.partial_entity(entity, set(entity.index)-set(contingency_set))
-                bad_entities = entities[self.predict(self.preprocess(entities)) == entity_prediction]
-                counters = bad_entities.apply(lambda b_e: self.counter(b_e, feature), axis=1)
-                
-                best_counter = max(best_counter, max(counters))
+                best_counter = max(best_counter, self.contingency_counter(entity, contingency_set, feature, entity_prediction)[0])
+                if best_counter >= highest_counter:
+                    break
             if best_counter > 0:
                 return (1/(1+size), best_counter) if get_counter else 1/(1+size)
         return (0.0, 0.0) if get_counter else 0.0
 
 
+    def x_resp_search(self, entity, feature, max_size=None):
+        if self.responsibility_mode not in ('greedy', 'beam'):
+            raise Exception('Responsibility mode not defined.')
+        entity = self.encoding.encode(entity)
+        entity_prediction = self.prediction(entity)
+        highest_counter = self.highest_counter(entity_prediction)
+        deadline = perf_counter() + self.responsibility_deadline if self.responsibility_deadline is not None else None
+        width = 1 if self.responsibility_mode == 'greedy' else self.beam_width
+
+        candidates = [f for f in self.encoding.features if f != feature]
+        max_size = len(candidates) if max_size is None else max_size-1
+        # freeing a feature that lowers the expected prediction a lot is likely to be part of a small contingency set
+        influence = {c: self.expected_prediction(entity, set(self.encoding.features)-{c}) for c in candidates}
+
+        evaluations, proven, frontier = 0, True, [()]
+        for size in range(max_size+1):
+            level = sorted({tuple(sorted(parent+(c,), key=candidates.index)) for parent in frontier for c in candidates if c not in parent} if size else {()},
+                           key=lambda contingency_set: sum(influence[c] for c in contingency_set))
+            exhaustive = len(level) == comb(len(candidates), size)
+
+            best_counter, scored, finished = 0, [], True
+            for contingency_set in level:
+                row_budget = self.responsibility_budget - evaluations if self.responsibility_budget is not None else None
+                counter, rows, finished = self.contingency_counter(entity, contingency_set, feature, entity_prediction, row_budget, deadline)
+                evaluations += rows
+                if not finished:
+                    break
+                scored.append((counter, contingency_set))
+                best_counter = max(best_counter, counter)
+                if best_counter >= highest_counter:
+                    exhaustive = True
+                    break
+
+            if best_counter > 0:
+                return Responsibility(1/(1+size), best_counter, proven and exhaustive and finished, evaluations)
+            if not finished:
+                return Responsibility(0.0, 0.0, False, evaluations)
+            proven = proven and exhaustive
+            frontier = [contingency_set for counter, contingency_set in sorted(scored, key=lambda e: -e[0])[:width]]
+        return Responsibility(0.0, 0.0, proven, evaluations)
+
+
+    def contingency_counter(self, entity, contingency_set, feature, entity_prediction, row_budget=None, deadline=None):
+        # rows that keep some contingency feature at its original value were already covered by a smaller set
+        best_counter, rows = float('-inf'), 0
+        for entities in self.encoding.variation_chunks(entity, contingency_set, self.chunk_size):
+            if (row_budget is not None and rows+len(entities) > row_budget) or (deadline is not None and perf_counter() > deadline):
+                return best_counter, rows, False
+            rows += len(entities)
+            bad_entities = entities[self.predict_codes(entities) == entity_prediction]
+            if len(bad_entities):
+                best_counter = max(best_counter, self.batch_counters(bad_entities, feature, entity_prediction).max())
+        return best_counter, rows, True
+
+
+    def highest_counter(self, entity_prediction):
+        return entity_prediction - min(self.classes) if self.classes is not None else float('inf')
+
+
+    def batch_counters(self, entities, feature, entity_prediction):
+        # a row without any weight has no expected value, the entity's own prediction stands in for it
+        expected_values = self.stored_expectations(entities, feature)
+        return entity_prediction - where(isnan(expected_values), entity_prediction, expected_values)
+
+
+    def stored_expectations(self, entities, feature):
+        if self.expectation_table is None and self.persistent_cache is None:
+            return self.batch_expectations(entities, feature)
+        # rows that only differ in the freed feature share their expected value
+        i = self.encoding.position[feature]
+        keys = self.encoding.keys(entities) - entities[:, i].astype(int64) * self.encoding.strides[i]
+        if self.expectation_table is not None:
+            keys = keys * len(self.encoding.features) + i
+            expected_values, found = self.expectation_table.lookup(keys)
+        else:
+            fixed_features, keys = set(self.encoding.features)-{feature}, keys.tolist()
+            expected_values, found = self.persistent_cache.lookup_many('batch_expectations', fixed_features, keys)
+            expected_values = array([nan if value is None else value for value in expected_values], dtype=float)
+            found = array(found, dtype=bool)
+        if not found.all():
+            expected_values[~found] = self.batch_expectations(entities[~found], feature)
+            if self.expectation_table is not None:
+                self.expectation_table.insert(keys[~found], expected_values[~found])
+            else:
+                self.persistent_cache.store_many('batch_expectations', fixed_features, [key for key, new in zip(keys, ~found) if new],
+                                                 [None if isnan(value) else value for value in expected_values[~found]])
+        return expected_values
+
+
+    def batch_expectations(self, entities, feature):
+        i = self.encoding.position[feature]
+        size = int(self.encoding.sizes[i])
+        rows = repeat(entities, size, axis=0)
+        rows[:, i] = tile(arange(size, dtype=rows.dtype), len(entities))
+
+        weights = self.weigh(rows, set(self.encoding.features)-{feature}).reshape(-1, size)
+        predictions = self.predict_codes(rows).reshape(-1, size)
+        total_weight = weights.sum(axis=1)
+        weighted_sum = (predictions * weights).sum(axis=1)
+        return where(total_weight == 0, nan, weighted_sum / where(total_weight == 0, 1, total_weight))
+
+
     def resp(self, entity, feature):
-        x_resp_score, best_counter = self.x_resp(entity, feature, get_counter=True)
+        result = self.x_resp(entity, feature, get_counter=True)
+        if isinstance(result, Responsibility):
+            return result._replace(score=result.score * result.counter)
+        x_resp_score, best_counter = result
         return x_resp_score * best_counter
 
 
     def shap(self, entity, feature):
-        return COOP_Game(self.expected_prediction).shapley(entity, {feature})
+        return self.shap_plus(entity, {feature})
+
+
+    def shap_all(self, entity):
+        if self.shapley_mode != 'exact':
+            return Series([self.shap(entity, feature) for feature in self.encoding.features], index=self.encoding.features)
+        entity = self.encoding.encode(entity)
+        game = COOP_Game(lambda team: self.expected_prediction(entity, team), rng=self.rng)
+        return Series(game.shapley_vector(self.encoding.features), index=self.encoding.features)
+
+
+    def coalition_table(self, entity):
+        entity = self.encoding.encode(entity)
+        for mask in range(2**len(self.encoding.features)):
+            self.submit_expectation(entity, coalition_players(self.encoding.features, mask))
+        return COOP_Game(lambda team: self.expected_prediction(entity, team), rng=self.rng).coalition_values(self.encoding.features)
+
+
+    def counter_plus_all(self, entity):
+        entity = self.encoding.encode(entity)
+        values = self.coalition_table(entity)
+        entity_prediction = self.prediction(entity)
+        return {coalition_players(self.encoding.features, mask): entity_prediction - values[(len(values)-1) ^ mask] for mask in range(len(values))}
+
+
+    def shap_plus_all(self, entity):
+        if self.shapley_mode != 'exact':
+            return {coalition_players(self.encoding.features, mask): self.shap_plus(entity, coalition_players(self.encoding.features, mask)) for mask in range(2**len(self.encoding.features))}
+        shapley_values = group_shapley_values(self.coalition_table(entity))
+        return {coalition_players(self.encoding.features, mask): shapley_values[mask] for mask in range(len(shapley_values))}
+
+
+    def explain_batch(self, entities, features=None, scores=('counter',)):
+        # rows come back per (score, feature, entity), runtime is the time one entity took for one score over all features
+        features = self.encoding.features if features is None else features
+        groups = [{feature} if isinstance(feature, str) else set(feature) for feature in features]
+        codes, inverse = unique(self.encoding.encode_frame(entities), axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+
+        runtimes = zeros((len(scores), len(codes)))
+        for s, score in enumerate(scores):
+            if score in ('counter', 'counter_plus'):
+                start = perf_counter()
+                for group in groups:
+                    self.prefetch(codes, set(self.encoding.features)-group)
+                runtimes[s] += (perf_counter()-start) / len(codes)
+
+        values = zeros((len(scores), len(groups), len(codes)))
+        for j, entity in enumerate(codes):
+            for s, score in enumerate(scores):
+                start = perf_counter()
+                values[s, :, j] = self.entity_scores(entity, score, features, groups)
+                runtimes[s, j] += perf_counter()-start
+
+        records = [(label, feature, score, values[s, g, j], runtimes[s, j])
+                   for s, score in enumerate(scores) for g, feature in enumerate(features) for label, j in zip(entities.index, inverse)]
+        return DataFrame(records, columns=['entity', 'feature', 'score', 'value', 'runtime'])
+
+
+    def entity_scores(self, entity, score, features, groups):
+        if score in ('counter', 'counter_plus'):
+            return [self.counter_plus(entity, group) for group in groups]
+        if score == 'shap' and all(len(group) == 1 for group in groups):
+            shap_values = self.shap_all(entity)
+            return [shap_values[feature] for group in groups for feature in group]
+        if score in ('shap', 'shap_plus'):
+            shap_values = self.shap_plus_all(entity)
+            return [shap_values[frozenset(group)] for group in groups]
+        if any(len(group) != 1 for group in groups):
+            raise Exception(f"Score '{score}' not defined for feature groups.")
+        features = [feature for group in groups for feature in group]
+        if score == 'x_resp':
+            return [self.x_resp(entity, feature, get_counter=False) for feature in features]
+        if score == 'resp':
+            return [getattr(result, 'score', result) for result in (self.resp(entity, feature) for feature in features)]
+        return [getattr(self, score)(entity, feature) for feature in features]
+
+
+    def prefetch(self, entities, fixed_features):
+        for entity in entities:
+            self.submit_expectation(entity, fixed_features)
+
+
+    def submit_expectation(self, entity, fixed_features):
+        # queue the rows an enumerated expectation will need, the oracle predicts them together with the next request
+        if self.tree_backend is not None or self.use_dense_grid:
+            return
+        if self.support is not None:
+            self.oracle.submit(self.support(entity, fixed_features)[0])
+            return
+        grid_size = self.encoding.grid_size(fixed_features)
+        sampled = self.sample is not None and self.sampling_threshold is not None and grid_size > self.sampling_threshold
+        if not sampled and grid_size <= self.chunk_size:
+            self.oracle.submit(self.encoding.grid(entity, fixed_features))
+
+
+    def shapley_interactions(self, entity):
+        interactions = shapley_interactions(self.coalition_table(entity))
+        return {coalition_players(self.encoding.features, mask): interactions[mask] for mask in range(len(interactions))}
 
 
     def shap_plus(self, entity, features):
-        return COOP_Game(self.expected_prediction).shapley(entity, set(features))
+        entity = self.encoding.encode(entity)
+        game = COOP_Game(lambda team: self.expected_prediction(entity, team), rng=self.rng)
+        if self.shapley_mode == 'exact':
+            return game.shapley(self.encoding.features, set(features))
+        elif self.shapley_mode == 'permutation':
+            return game.shapley_permutation(self.encoding.features, set(features), **self.shapley_sampling)
+        elif self.shapley_mode == 'kernel':
+            return game.shapley_kernel(self.encoding.features, set(features), **self.shapley_sampling)
+        else:
+            raise Exception('Shapley mode not defined.')
 
 
 
 class COOP_Game:
-    def __init__(self, game_function):
+    def __init__(self, game_function, rng=None):
         self.GAME_FUNCTION = game_function
+        self.rng = default_rng() if rng is None else rng
 
     def shapley(self, all_players, player):
         shapley_value = 0
         for size in range(len(all_players)):
             coefficient = (factorial(size)*factorial(len(all_players)-size-1)) / (factorial(len(all_players)))
-            for team in combinations(set(all_players.index)-set(player), size):
-                shapley_value += coefficient * (self.GAME_FUNCTION(all_players, set(player).union(team)) - self.GAME_FUNCTION(all_players, team))
+            for team in combinations(set(all_players)-set(player), size):
+                shapley_value += coefficient * (self.GAME_FUNCTION(set(player).union(team)) - self.GAME_FUNCTION(team))
         
-        return shapley_value
\ No newline at end of file
+        return shapley_value
+
+
+    def coalition_values(self, all_players):
+        players = list(all_players)
+        return array([self.GAME_FUNCTION({player for i, player in enumerate(players) if mask >> i & 1}) for mask in range(2**len(players))], dtype=float)
+
+
+    def shapley_vector(self, all_players):
+        players = list(all_players)
+        values = self.coalition_values(players)
+        masks = arange(2**len(players))
+        sizes = coalition_sizes(len(players))
+        coefficients = array([factorial(size)*factorial(len(players)-size-1) / factorial(len(players)) for size in range(len(players))])
+
+        shapley_values = zeros(len(players))
+        for i in range(len(players)):
+            teams = masks[(masks >> i) & 1 == 0]
+            shapley_values[i] = (coefficients[sizes[teams]] * (values[teams | (1 << i)] - values[teams])).sum()
+        return shapley_values
+
+
+    def shapley_permutation(self, all_players, player, tolerance=0.01, confidence=0.95, budget=2000):
+        # sum over teams of |T|!(n-|T|-1)!/n! * marginal contribution equals, for a random order of all players,
+        # the expected marginal contribution of the team preceding the first member of player, divided by |player|
+        players, player = list(all_players), set(player)
+        if not player:
+            return Estimate(0.0)
+        z = NormalDist().inv_cdf((1+confidence)/2)
+        evaluations, total, total_squares, samples = 0, 0.0, 0.0, 0
+        while evaluations+4 <= budget:
+            order = self.rng.permutation(len(players))
+            contribution = 0
+            for permutation in (order, order[::-1]):
+                team = set()
+                for i in permutation:
+                    if players[i] in player:
+                        break
+                    team.add(players[i])
+                contribution += (self.GAME_FUNCTION(player.union(team)) - self.GAME_FUNCTION(team)) / (2*len(player))
+            evaluations += 4
+            samples += 1
+            total += contribution
+            total_squares += contribution**2
+
+            standard_error = sqrt(max(total_squares/samples - (total/samples)**2, 0) / (samples-1)) if samples > 1 else float('inf')
+            if samples >= 30 and z*standard_error <= tolerance:
+                break
+        return Estimate(total/samples if samples else 0.0, standard_error if samples > 1 else 0.0, evaluations)
+
+
+    def shapley_kernel(self, all_players, player, tolerance=0.01, confidence=0.95, budget=2000, groups=5):
+        # weighted least squares estimator with paired samples, only defined for single players
+        players, player = list(all_players), set(player)
+        if len(player) != 1 or len(players) < 3:
+            return self.shapley_permutation(all_players, player, tolerance, confidence, budget)
+        n, index = len(players), players.index(next(iter(player)))
+        z = NormalDist().inv_cdf((1+confidence)/2)
+        empty_value = self.GAME_FUNCTION(set())
+        total_gain = self.GAME_FUNCTION(set(players)) - empty_value
+        sizes = arange(1, n)
+        size_distribution = (n-1) / (sizes*(n-sizes))
+        size_distribution /= size_distribution.sum()
+
+        coalitions, values = [], []
+        evaluations = 2
+        estimate, standard_error = None, float('inf')
+        while evaluations+2 <= budget:
+            coalition = zeros(n, dtype=bool)
+            coalition[self.rng.choice(n, self.rng.choice(sizes, p=size_distribution), replace=False)] = True
+            for mask in (coalition, ~coalition):
+                coalitions.append(mask)
+                values.append(self.GAME_FUNCTION({players[i] for i in flatnonzero(mask)}) - empty_value)
+            evaluations += 2
+
+            if len(coalitions) % (2*n*groups) == 0:
+                Z, y = array(coalitions, dtype=float), array(values)
+                estimate = kernel_regression(Z, y, total_gain)[index]
+                parts = [kernel_regression(Z[g::groups], y[g::groups], total_gain)[index] for g in range(groups)]
+                standard_error = array(parts).std(ddof=1) / sqrt(groups)
+                if z*standard_error <= tolerance:
+                    break
+        if estimate is None or len(coalitions) % (2*n*groups) != 0:
+            estimate = kernel_regression(array(coalitions, dtype=float), array(values), total_gain)[index]
+        return Estimate(estimate, standard_error if standard_error != float('inf') else 0.0, evaluations)
+
+
+
+def kernel_regression(coalitions, values, total_gain):
+    A = coalitions.T @ coalitions / len(coalitions)
+    b = coalitions.T @ values / len(coalitions)
+    A_inverse = pinv(A)
+    correction = (ones(len(A)) @ A_inverse @ b - total_gain) / (ones(len(A)) @ A_inverse @ ones(len(A)))
+    return A_inverse @ (b - correction*ones(len(A)))
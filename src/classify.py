@@ -1,4 +1,5 @@
-from numpy import array
+from numpy import array, zeros, empty, concatenate, array_equal, arange, bincount, cumsum, searchsorted, intc
+from scipy.sparse import csr_matrix
 from pandas import DataFrame, Series, concat, cut, qcut
 from sklearn.model_selection import train_test_split, GridSearchCV
 from sklearn.metrics import confusion_matrix, accuracy_score, precision_score, recall_score
@@ -10,9 +11,10 @@ from sklearn.metrics import confusion_matrix, accuracy_score, precision_score, r
 
 
 class Preparer:
-    def __init__(self, missing={}, one_hot={}, scale={}, drop=[], map_values={}):
+    def __init__(self, missing={}, one_hot={}, scale={}, drop=[], map_values={}, sparse=False):
         self.not_yet_fit = True
         
+        self.sparse = sparse
         self.missing = missing
         self.one_hot = one_hot
         self.scale = scale
@@ -33,10 +35,13 @@ class Preparer:
 
 
     @staticmethod
-    def transform_data(data, preparation_config, fit, results_in_more_columns=False):
+    def transform_data(data, preparation_config, fit, results_in_more_columns=False, sparse=False):
         for encoder,columns in preparation_config.items():
             encoded_data = encoder.fit_transform(data[columns]) if fit else encoder.transform(data[columns])
-            if results_in_more_columns:
+            if results_in_more_columns and sparse:
+                one_hot_data = DataFrame.sparse.from_spmatrix(csr_matrix(encoded_data, dtype=bool), columns=encoder.get_feature_names_out())
+                data = concat([data.drop(columns=columns), one_hot_data], axis=1)
+            elif results_in_more_columns:
                 one_hot_data = DataFrame(encoded_data.toarray(), columns=encoder.get_feature_names_out(), dtype=bool)
                 data = concat([data.drop(columns=columns), one_hot_data], axis=1)
             else:
@@ -49,7 +54,7 @@ class Preparer:
             data_pp = data_pp.to_frame().transpose().reset_index(drop=True)
 
         data_pp = self.transform_data(data_pp, self.missing, self.not_yet_fit)
-        data_pp = self.transform_data(data_pp, self.one_hot, self.not_yet_fit, results_in_more_columns=True)
+        data_pp = self.transform_data(data_pp, self.one_hot, self.not_yet_fit, results_in_more_columns=True, sparse=self.sparse)
         data_pp = self.transform_data(data_pp, self.scale, self.not_yet_fit)
 
         if self.drop:
@@ -64,6 +69,83 @@ class Preparer:
         return data_pp
 
 
+    def compile(self, encoding, samples=256, seed=0):
+        if self.not_yet_fit:
+            raise ValueError('The preparer has to be fit before it can be compiled.')
+        return CompiledPreparer(self, encoding, samples, seed)
+
+
+
+class CompiledPreparer:
+    # the fitted transformations frozen into one block of model columns per feature, looked up by the feature's codes
+    def __init__(self, preparer, encoding, samples=256, seed=0):
+        base = zeros(len(encoding.features), dtype=encoding.dtype)
+        variations = [encoding.grid(base, set(encoding.features)-{feature}) for feature in encoding.features]
+        frame = preparer.preprocess(encoding.decode(concatenate([base[None]]+variations)))
+        self.columns = frame.columns
+        inputs = frame.to_numpy(dtype=float)
+        base_input, inputs = inputs[0], inputs[1:]
+
+        self.blocks, owner, start = [], zeros(inputs.shape[1], dtype=int)-1, 0
+        for i, size in enumerate(encoding.sizes):
+            block = inputs[start:start+size]
+            columns = (block != base_input).any(axis=0).nonzero()[0]
+            if (owner[columns] != -1).any():
+                raise ValueError('A model column depends on more than one feature.')
+            owner[columns] = i
+            self.blocks.append((columns, block[:, columns]))
+            start += size
+        self.constant_columns = (owner == -1).nonzero()[0]
+        self.constant_values = base_input[self.constant_columns]
+        self.nonzero_constants = self.constant_columns[self.constant_values != 0]
+
+        codes = encoding.random_codes(samples, seed)
+        inputs = self(codes)
+        if not array_equal(inputs, preparer.preprocess(encoding.decode(codes)).to_numpy(dtype=float), equal_nan=True):
+            raise ValueError('The compiled preparer disagrees with preprocess.')
+        if not array_equal(self.sparse(codes).toarray(), inputs, equal_nan=True):
+            raise ValueError('The sparse compiled preparer disagrees with the dense one.')
+
+
+    def __call__(self, codes):
+        inputs = empty((len(codes), len(self.columns)))
+        inputs[:, self.constant_columns] = self.constant_values
+        for i, (columns, values) in enumerate(self.blocks):
+            inputs[:, columns] = values[codes[:, i]]
+        return inputs
+
+
+    def frame(self, codes):
+        return DataFrame(self(codes), columns=self.columns)
+
+
+    def sparse(self, codes, dtype=float):
+        # only the non-zero entries of every feature block are gathered, so no dense row is ever built
+        counts = zeros(len(codes), dtype=intc) + len(self.nonzero_constants)
+        blocks = []
+        for i, (block_columns, values) in enumerate(self.blocks):
+            block = values[codes[:, i]]
+            block_rows, block_positions = block.nonzero()
+            counts += bincount(block_rows, minlength=len(codes)).astype(intc)
+            blocks.append((block_rows, block_columns[block_positions].astype(intc), block[block_rows, block_positions].astype(dtype)))
+
+        # every row's entries go to the slots after those of the earlier blocks, so no coo matrix has to be sorted
+        indptr = zeros(len(codes)+1, dtype=intc)
+        cumsum(counts, out=indptr[1:])
+        filled = indptr[:-1].copy()
+        indices, data = empty(indptr[-1], dtype=intc), empty(indptr[-1], dtype=dtype)
+        for k, (column, value) in enumerate(zip(self.nonzero_constants, self.constant_values[self.constant_values != 0])):
+            indices[filled] = column
+            data[filled] = value
+            filled += 1
+        for block_rows, block_columns, block_values in blocks:
+            slots = filled[block_rows] + (arange(len(block_rows)) - searchsorted(block_rows, block_rows)).astype(intc)
+            indices[slots] = block_columns
+            data[slots] = block_values
+            filled += bincount(block_rows, minlength=len(codes)).astype(intc)
+        return csr_matrix((data, indices, indptr), shape=(len(codes), len(self.columns)))
+
+
 
 ################################################################################
 ################################## SPLITTING ###################################
@@ -0,0 +1,75 @@
+from math import factorial
+from numpy import arange, array, zeros, where
+
+
+
+def number_of_players(values):
+    return len(values).bit_length() - 1
+
+
+def coalition_sizes(number_of_players):
+    masks = arange(2**number_of_players)
+    return sum(((masks >> i) & 1 for i in range(number_of_players)), zeros(len(masks), dtype=int))
+
+
+def coalition_players(players, mask):
+    return frozenset(player for i, player in enumerate(players) if mask >> i & 1)
+
+
+def subset_sums(values):
+    sums = array(values, dtype=float)
+    for i in range(number_of_players(sums)):
+        view = sums.reshape(-1, 2, 1 << i)
+        view[:, 1, :] += view[:, 0, :]
+    return sums
+
+
+def superset_sums(values):
+    sums = array(values, dtype=float)
+    for i in range(number_of_players(sums)):
+        view = sums.reshape(-1, 2, 1 << i)
+        view[:, 0, :] += view[:, 1, :]
+    return sums
+
+
+def mobius(values):
+    coefficients = array(values, dtype=float)
+    for i in range(number_of_players(coefficients)):
+        view = coefficients.reshape(-1, 2, 1 << i)
+        view[:, 1, :] -= view[:, 0, :]
+    return coefficients
+
+
+def shapley_coefficients(number_of_players):
+    n = number_of_players
+    return array([factorial(size)*factorial(n-size-1) / factorial(n) for size in range(n)] + [0.0])
+
+
+def group_shapley_values(values):
+    # phi(G) = sum over T in N\G of w(|T|) * (v(T+G) - v(T)) with w(t) = t!(n-t-1)!/n! for every group G at once:
+    # the v(T) part is a subset sum evaluated at the complement of G, the v(T+G) part a superset sum per group size
+    n = number_of_players(values)
+    masks = arange(len(values))
+    sizes = coalition_sizes(n)
+    coefficients = shapley_coefficients(n)
+
+    without_group = subset_sums(coefficients[sizes] * values)[(len(values)-1) ^ masks]
+    with_group = zeros(len(values))
+    for group_size in range(1, n+1):
+        sums = superset_sums(where(sizes >= group_size, coefficients[(sizes-group_size).clip(0)], 0) * values)
+        with_group[sizes == group_size] = sums[sizes == group_size]
+
+    shapley_values = with_group - without_group
+    shapley_values[0] = 0.0
+    return shapley_values
+
+
+def shapley_interactions(values):
+    sizes = coalition_sizes(number_of_players(values))
+    dividends = mobius(values)
+
+    interactions = zeros(len(values))
+    for size in range(number_of_players(values)+1):
+        sums = superset_sums(where(sizes >= size, dividends / (sizes-size+1).clip(1), 0))
+        interactions[sizes == size] = sums[sizes == size]
+    return interactions
@@ -1,4 +1,5 @@
-from numpy import prod
+from numpy import prod, ones, array, zeros, unique, searchsorted, minimum, repeat, argsort
+from hashlib import sha256
 
 
 
@@ -17,8 +18,32 @@ def define_fully_factorized_distribution(data):
     feature_occurrences = {}
     for domain in data.columns:
         feature_occurrences[domain] = data[domain].groupby(data[domain]).count().to_dict()
+    feature_probabilities = {feature: {value: count / len(data) for value, count in occurrences.items()} for feature, occurrences in feature_occurrences.items()}
+
     def fully_factorized_distribution(entity, fixed_features):
         return prod([feature_occurrences[feature][entity[feature]] / len(data) for feature in data.columns if feature not in fixed_features])
+
+    def compile_fully_factorized(encoding):
+        probabilities = [array([feature_probabilities[feature].get(value, 0) for value in values]) for feature, values in zip(encoding.features, encoding.values)]
+
+        def fully_factorized_code_weights(codes, fixed_features):
+            weights = ones(len(codes))
+            for i in encoding.free(fixed_features):
+                weights *= probabilities[i][codes[:, i]]
+            return weights
+
+        def fully_factorized_sample(codes, fixed_features, size, rng):
+            samples = repeat(codes[None], size, axis=0)
+            for i in encoding.free(fixed_features):
+                samples[:, i] = rng.choice(len(probabilities[i]), size, p=probabilities[i]/probabilities[i].sum())
+            return samples
+
+        fully_factorized_code_weights.sample = fully_factorized_sample
+        fully_factorized_code_weights.factors = probabilities
+        fully_factorized_code_weights.fingerprint = content_fingerprint('fully_factorized', *probabilities)
+        return fully_factorized_code_weights
+
+    fully_factorized_distribution.compile = compile_fully_factorized
     return fully_factorized_distribution
 
 
@@ -29,8 +54,77 @@ def define_experimental_distribution(data):
         if tuple(entity) in occurrences:
             return occurrences[tuple(entity)]
         return 0
+
+    def compile_experimental(encoding):
+        observed = encoding.encode_frame(data)
+        keys, first, counts = unique(encoding.keys(observed), return_index=True, return_counts=True)
+        rows = observed[first]
+        projections = {}
+
+        def projection_index(fixed_features):
+            fixed = encoding.fixed(fixed_features)
+            if tuple(fixed) not in projections:
+                projection_keys = encoding.keys(rows[:, fixed], encoding.strides[fixed])
+                order = argsort(projection_keys, kind='stable')
+                projections[tuple(fixed)] = (fixed, projection_keys[order], order)
+            return projections[tuple(fixed)]
+
+        def experimental_code_weights(codes, fixed_features):
+            row_keys = encoding.keys(codes)
+            positions = minimum(searchsorted(keys, row_keys), len(keys)-1)
+            weights = zeros(len(codes))
+            found = keys[positions] == row_keys
+            weights[found] = counts[positions[found]]
+            return weights
+
+        def experimental_support(codes, fixed_features):
+            fixed, projection_keys, order = projection_index(fixed_features)
+            key = encoding.keys(codes[fixed], encoding.strides[fixed])
+            matching = order[searchsorted(projection_keys, key, side='left'):searchsorted(projection_keys, key, side='right')]
+            return rows[matching], counts[matching].astype(float)
+
+        def experimental_sample(codes, fixed_features, size, rng):
+            matching, weights = experimental_support(codes, fixed_features)
+            if len(matching) == 0:
+                return matching
+            return matching[rng.choice(len(matching), size, p=weights/weights.sum())]
+
+        experimental_code_weights.support = experimental_support
+        experimental_code_weights.sample = experimental_sample
+        experimental_code_weights.fixed_invariant = True
+        experimental_code_weights.fingerprint = content_fingerprint('experimental', keys, counts)
+        return experimental_code_weights
+
+    experimental_distribution.compile = compile_experimental
     return experimental_distribution
 
 
 def uniform_distribution(entity, fixed_features):
-    return 1
\ No newline at end of file
+    return 1
+
+
+def compile_uniform(encoding):
+    def uniform_code_weights(codes, fixed_features):
+        return ones(len(codes))
+
+    def uniform_sample(codes, fixed_features, size, rng):
+        samples = repeat(codes[None], size, axis=0)
+        for i in encoding.free(fixed_features):
+            samples[:, i] = rng.integers(0, encoding.sizes[i], size)
+        return samples
+
+    uniform_code_weights.sample = uniform_sample
+    uniform_code_weights.factors = [ones(size) for size in encoding.sizes]
+    uniform_code_weights.fingerprint = content_fingerprint('uniform', encoding.sizes)
+    return uniform_code_weights
+
+
+uniform_distribution.compile = compile_uniform
+
+
+
+def content_fingerprint(name, *arrays):
+    digest = sha256(name.encode())
+    for values in arrays:
+        digest.update(repr(values.tolist()).encode() if values.dtype == object else values.tobytes())
+    return digest.hexdigest()
@@ -0,0 +1,140 @@
+from numpy import array, arange, empty, zeros, int8, int16, int32, int64, iinfo, ndarray
+from numpy.random import default_rng
+from pandas import DataFrame
+
+
+
+class Encoding:
+    def __init__(self, domains, features=None):
+        self.features = list(domains.keys() if features is None else features)
+        self.position = {feature: i for i, feature in enumerate(self.features)}
+        self.values = [ordered_values(domains[feature]) for feature in self.features]
+        self.labels = [array(values, dtype=object) for values in self.values]
+        self.codes = [{value: code for code, value in enumerate(values)} for values in self.values]
+        self.fallback_codes = [{str(value): code for code, value in enumerate(values)} for values in self.values]
+        self.sizes = array([len(values) for values in self.values], dtype=int64)
+        self.dtype = code_type(self.sizes.max(initial=1))
+        self.strides = mixed_radix_strides(self.sizes)
+        self.signature = tuple((feature, tuple(values)) for feature, values in zip(self.features, self.values))
+
+
+    def code(self, feature, value):
+        i = self.position[feature]
+        if value in self.codes[i]:
+            return self.codes[i][value]
+        if str(value) in self.fallback_codes[i]:
+            return self.fallback_codes[i][str(value)]
+        raise ValueError(f"Value {value!r} is not in the domain of feature '{feature}'.")
+
+
+    def encode(self, entity):
+        if isinstance(entity, ndarray):
+            return entity
+        return array([self.code(feature, entity[feature]) for feature in self.features], dtype=self.dtype)
+
+
+    def encode_frame(self, entities):
+        codes = empty((len(entities), len(self.features)), dtype=self.dtype)
+        for i, feature in enumerate(self.features):
+            codes[:, i] = entities[feature].map(lambda value: self.code(feature, value)).to_numpy()
+        return codes
+
+
+    def decode(self, codes):
+        return DataFrame({feature: self.labels[i][codes[:, i]] for i, feature in enumerate(self.features)}, columns=self.features).infer_objects()
+
+
+    def random_codes(self, samples, seed=0):
+        rng = default_rng(seed)
+        codes = zeros((samples, len(self.features)), dtype=self.dtype)
+        for i, size in enumerate(self.sizes):
+            codes[:, i] = rng.integers(0, size, samples)
+        return codes
+
+
+    def free(self, fixed_features):
+        return [i for i, feature in enumerate(self.features) if feature not in fixed_features]
+
+
+    def grid_size(self, fixed_features):
+        return int(self.sizes[self.free(fixed_features)].prod())
+
+
+    def grid(self, codes, fixed_features):
+        free = self.free(fixed_features)
+        return self.grid_rows(codes, free, 0, int(self.sizes[free].prod()))
+
+
+    def grid_chunks(self, codes, fixed_features, chunk_size):
+        free = self.free(fixed_features)
+        size = int(self.sizes[free].prod())
+        for start in range(0, size, chunk_size):
+            yield self.grid_rows(codes, free, start, min(start+chunk_size, size))
+
+
+    def grid_rows(self, codes, free, start, stop):
+        grid = empty((stop-start, len(self.features)), dtype=self.dtype)
+        grid[:] = codes
+        index = arange(start, stop, dtype=int64)
+        for i in reversed(free):
+            index, grid[:, i] = divmod(index, self.sizes[i])
+        return grid
+
+
+    def variation_chunks(self, codes, changed, chunk_size):
+        # rows that differ from codes on every changed feature and agree with it everywhere else
+        changed = [self.position[feature] for feature in changed]
+        radices = self.sizes[changed] - 1
+        size = int(radices.prod())
+        for start in range(0, size, chunk_size):
+            grid = empty((min(start+chunk_size, size)-start, len(self.features)), dtype=self.dtype)
+            grid[:] = codes
+            index = arange(start, start+len(grid), dtype=int64)
+            for i, radix in reversed(list(zip(changed, radices))):
+                index, value = divmod(index, radix)
+                grid[:, i] = value + (value >= codes[i])
+            yield grid
+
+
+    def row_bytes(self):
+        return 8 * (2*len(self.features) + int(self.sizes.sum()))
+
+
+    def fixed(self, fixed_features):
+        return [i for i, feature in enumerate(self.features) if feature in fixed_features]
+
+
+    def projection_key(self, codes, fixed_features):
+        fixed = self.fixed(fixed_features)
+        return (frozenset(self.features[i] for i in fixed), self.keys(codes[fixed], self.strides[fixed]))
+
+
+    def keys(self, codes, strides=None):
+        strides = self.strides if strides is None else strides
+        if strides.dtype == object:
+            return codes.astype(object) @ strides
+        return codes.astype(int64) @ strides
+
+
+
+def ordered_values(values):
+    try:
+        return sorted(values)
+    except TypeError:
+        return sorted(values, key=repr)
+
+
+def code_type(size):
+    for dtype in (int8, int16, int32):
+        if size <= iinfo(dtype).max:
+            return dtype
+    return int64
+
+
+def mixed_radix_strides(sizes):
+    strides = [1]
+    for size in reversed(sizes[1:].tolist()):
+        strides.insert(0, strides[0] * size)
+    if strides[0] * int(sizes[0]) > iinfo(int64).max:
+        return array(strides, dtype=object)
+    return array(strides, dtype=int64)
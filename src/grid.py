@@ -0,0 +1,33 @@
+from numpy import ones, zeros, multiply
+
+
+
+class DenseGrid:
+    def __init__(self, encoding, oracle, weights):
+        self.encoding = encoding
+        self.predictions = oracle.tensor()
+        self.factors = getattr(weights, 'factors', None)
+        if self.factors is None:
+            self.weights = weights(encoding.grid(zeros(len(encoding.features), dtype=encoding.dtype), ()), frozenset()).reshape(encoding.sizes)
+
+
+    @staticmethod
+    def supports(weights):
+        return hasattr(weights, 'factors') or getattr(weights, 'fixed_invariant', False)
+
+
+    def expectation(self, codes, fixed_features):
+        fixed = set(self.encoding.fixed(fixed_features))
+        index = tuple(int(codes[i]) if i in fixed else slice(None) for i in range(len(self.encoding.features)))
+        predictions = self.predictions[index]
+        if self.factors is not None:
+            weights = ones(())
+            for i in self.encoding.free(fixed_features):
+                weights = multiply.outer(weights, self.factors[i])
+        else:
+            weights = self.weights[index]
+
+        total_weight = weights.sum()
+        if total_weight == 0:
+            return None
+        return (predictions * weights).sum() / total_weight
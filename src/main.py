@@ -3,13 +3,21 @@ from constants import dataset_configurations, classifier_configurations
 from classify import Preparer, split_data, train_model, test_model, print_results
 from distributions import get_distribution
 from Explainer import Explainer
+from store import ResultStore, export_dat
 
-from os import makedirs
+from os import makedirs, fsync, replace
 from os.path import dirname, realpath, exists
 from itertools import product
+from concurrent.futures import ProcessPoolExecutor
 from more_itertools import powerset
 from pandas import read_csv, DataFrame, Series
+from pandas.util import hash_pandas_object
+from numpy import ndarray
+from hashlib import sha256
+from pickle import dumps
+from json import loads, dumps as dumps_json
 from time import perf_counter
+from inspect import signature
 import logging
 
 
@@ -19,6 +27,15 @@ RESULTS_PREFIX = f"{dirname(realpath(__file__))}/results"
 if not exists(RESULTS_PREFIX):
     makedirs(RESULTS_PREFIX)
 FORCE_CLASSIFICATION = False
+RESUME = True
+MANIFEST_FILE = f"{RESULTS_PREFIX}/manifest.jsonl"
+CHECKPOINT_SECONDS = 10
+CHECKPOINT_CELLS = 1000
+PERSISTENT_CACHE = f"{RESULTS_PREFIX}/expectations.sqlite"
+EXPLAINER_SETTINGS = {}
+WORKERS = 1
+ENTITY_CHUNK_SIZE = 4
+worker_state = {}
 logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
 
 configs = {
@@ -55,7 +72,9 @@ configs = {
 
 
 @timer
-def main(configs):
+def main(configs, workers=WORKERS, chunk_size=ENTITY_CHUNK_SIZE, resume=RESUME):
+    contexts, tasks, outputs = {}, [], []
+    manifest = load_manifest(MANIFEST_FILE)
     for dataset_name in configs.keys():
         dataset_config = dataset_configurations[dataset_name]
         logging.debug(f"DATASET: {dataset_name}")
@@ -89,38 +108,151 @@ def main(configs):
                     continue
                 entities.append(prepared_entity)
 
+            contexts[(dataset_name, classifier_name)] = (classifier, preparer, data, domains, entities, configs[dataset_name]['features'])
+            context_hash = content_hash(dataset_name, hash_pandas_object(data, index=False).to_numpy(), dumps(classifier), configs[dataset_name]['features'],
+                                        dataset_config.get('preprocessing'), explainer_settings())
             for distribution_name in configs[dataset_name]['distributions']:
-                logging.debug(f"DISTRIBUTION: {distribution_name}")
-                distribution = get_distribution(distribution_name, data)
-
-                for function_name in configs[dataset_name]['single_feature_functions']:
-                    explainer = get_explainer(classifier, preparer, distribution, domains)
-                    score_function = getattr(explainer, function_name)
-
-                    with open(f"{RESULTS_PREFIX}/single_{dataset_name}_{distribution_name}_{function_name}.dat", 'w') as f:
-                        f.write(' '.join(configs[dataset_name]['features'])+" Runtime\n")
-                        for entity in entities:
-                            start_time = perf_counter()
-                            scores = [str(score_function(entity, feature)) for feature in configs[dataset_name]['features']]
-                            end_time = perf_counter()
-
-                            f.write(' '.join(scores) + f" {(end_time-start_time):.8f}\n")
-                            f.flush()
-
-                for function_name in configs[dataset_name]['multi_feature_functions']:
-                    explainer = get_explainer(classifier, preparer, distribution, domains)
-                    score_function = getattr(explainer, function_name)
-
-                    with open(f"{RESULTS_PREFIX}/multiple_{dataset_name}_{distribution_name}_{function_name}.dat", 'w') as f:
-                        feature_combinations = list(powerset(configs[dataset_name]['features']))
-                        f.write(' '.join('_'.join(feature_combination) for feature_combination in feature_combinations)+" Runtime\n")
-                        for entity in entities:
-                            start_time = perf_counter()
-                            scores = [str(score_function(entity, feature_combination)) for feature_combination in feature_combinations]
-                            end_time = perf_counter()
-
-                            f.write(' '.join(scores) + f" {(end_time-start_time):.8f}\n")
-                            f.flush()
+                for kind, functions in (('single', 'single_feature_functions'), ('multiple', 'multi_feature_functions')):
+                    for function_name in configs[dataset_name][functions]:
+                        keys = [content_hash(context_hash, distribution_name, kind, function_name, entity.tolist()) for entity in entities]
+                        outputs.append(((kind, dataset_name, distribution_name, function_name), keys))
+                        missing = [entity_id for entity_id, key in enumerate(keys) if not resume or key not in manifest]
+                        for start in range(0, len(missing), chunk_size):
+                            tasks.append(((kind, dataset_name, classifier_name, distribution_name, function_name, tuple(missing[start:start+chunk_size])), keys))
+
+    if not resume:
+        drop_cells(manifest, {keys[entity_id] for task, keys in tasks for entity_id in task[-1]})
+    # finished tasks are checkpointed into the manifest right away, the outputs are then written from it
+    logging.debug(f"CELLS: {sum(len(keys) for output, keys in outputs)} ({sum(len(task[-1]) for task, keys in tasks)} to compute)")
+    if workers > 1:
+        with ProcessPoolExecutor(workers, initializer=initialize_worker, initargs=(contexts,)) as executor:
+            checkpoint(manifest, tasks, executor.map(run_task, [task for task, keys in tasks]))
+    else:
+        initialize_worker(contexts)
+        checkpoint(manifest, tasks, map(run_task, [task for task, keys in tasks]))
+    write_results(configs, outputs, manifest)
+
+
+def initialize_worker(contexts):
+    worker_state['contexts'] = contexts
+    worker_state['explainer'] = (None, None)
+
+
+def run_task(task):
+    kind, dataset_name, classifier_name, distribution_name, function_name, entity_ids = task
+    classifier, preparer, data, domains, entities, features = worker_state['contexts'][(dataset_name, classifier_name)]
+
+    # tasks of one output file arrive in order, so a worker keeps the explainer (and its caches) of its last file
+    key, explainer = worker_state['explainer']
+    if key != (kind, dataset_name, classifier_name, distribution_name, function_name):
+        if explainer is not None:
+            explainer.close()
+        if key is not None and key[1:3] != (dataset_name, classifier_name):
+            # the last model's oracle only lives on in the old explainer, dropping that first frees it before the next one is built
+            worker_state['explainer'], explainer = (None, None), None
+        logging.debug(f"DISTRIBUTION: {distribution_name}")
+        explainer = get_explainer(classifier, preparer, get_distribution(distribution_name, data), domains)
+        worker_state['explainer'] = ((kind, dataset_name, classifier_name, distribution_name, function_name), explainer)
+
+    rows = []
+    for entity_id in entity_ids:
+        entity = entities[entity_id]
+        start_time = perf_counter()
+        scores = compute_scores(explainer, kind, function_name, entity, features)
+        end_time = perf_counter()
+        rows.append((entity_id, scores, end_time-start_time))
+    if explainer.persistent_cache is not None:
+        explainer.persistent_cache.flush()
+    logging.debug(f"CACHE: {explainer.cache_statistics()}")
+    return rows
+
+
+def compute_scores(explainer, kind, function_name, entity, features):
+    if kind == 'single':
+        if function_name == 'shap':
+            shap_values = explainer.shap_all(entity)
+            return [shap_values[feature] for feature in features]
+        return [getattr(explainer, function_name)(entity, feature) for feature in features]
+
+    feature_combinations = list(powerset(features))
+    if hasattr(explainer, f"{function_name}_all"):
+        values = getattr(explainer, f"{function_name}_all")(entity)
+        return [values[frozenset(feature_combination)] for feature_combination in feature_combinations]
+    return [getattr(explainer, function_name)(entity, feature_combination) for feature_combination in feature_combinations]
+
+
+def write_results(configs, outputs, manifest):
+    for (kind, dataset_name, distribution_name, function_name), keys in outputs:
+        features = configs[dataset_name]['features']
+        feature_sets = [(feature,) for feature in features] if kind == 'single' else list(powerset(features))
+        name = f"{RESULTS_PREFIX}/{kind}_{dataset_name}_{distribution_name}_{function_name}"
+        with ResultStore(name, features, feature_sets) as store:
+            for entity_id, key in enumerate(keys):
+                scores, runtime = manifest[key]
+                store.append(entity_id, scores, runtime)
+        export_dat(name, f"{name}.dat")
+
+
+def content_hash(*parts):
+    digest = sha256()
+    for part in parts:
+        digest.update(part.tobytes() if isinstance(part, ndarray) else part if isinstance(part, bytes) else repr(part).encode())
+    return digest.hexdigest()
+
+
+def load_manifest(manifest_file):
+    # one json line per computed cell, a line cut off by a crash is simply computed again
+    manifest = {}
+    if exists(manifest_file):
+        with open(manifest_file) as f:
+            lines = f.readlines()
+        for line in lines:
+            try:
+                cell = loads(line)
+            except ValueError:
+                continue
+            manifest[cell['key']] = ([tuple(score) if isinstance(score, list) else score for score in cell['scores']], cell['runtime'])
+        if lines and not lines[-1].endswith("\n"):
+            with open(manifest_file, 'a') as f:
+                f.write("\n")
+    return manifest
+
+
+def drop_cells(manifest, dropped):
+    # only the cells this run computes again leave the manifest, those of other datasets and settings stay
+    for key in dropped:
+        manifest.pop(key, None)
+    if exists(MANIFEST_FILE):
+        with open(MANIFEST_FILE) as f:
+            lines = f.readlines()
+        with open(f"{MANIFEST_FILE}.tmp", 'w') as f:
+            for line in lines:
+                try:
+                    if loads(line)['key'] not in dropped:
+                        f.write(line if line.endswith("\n") else line+"\n")
+                except ValueError:
+                    continue
+            f.flush()
+            fsync(f.fileno())
+        replace(f"{MANIFEST_FILE}.tmp", MANIFEST_FILE)
+
+
+def checkpoint(manifest, tasks, results):
+    # the manifest only goes to disk every CHECKPOINT_CELLS cells or CHECKPOINT_SECONDS seconds, that bounds what a crash loses
+    with open(MANIFEST_FILE, 'a') as f:
+        cells, synced = 0, perf_counter()
+        for (task, keys), rows in zip(tasks, results):
+            for entity_id, scores, runtime in rows:
+                scores = [tuple(float(value) for value in score) if isinstance(score, tuple) else float(score) for score in scores]
+                manifest[keys[entity_id]] = (scores, runtime)
+                f.write(dumps_json({'key': keys[entity_id], 'scores': scores, 'runtime': runtime})+"\n")
+                cells += 1
+            if cells >= CHECKPOINT_CELLS or perf_counter()-synced >= CHECKPOINT_SECONDS:
+                f.flush()
+                fsync(f.fileno())
+                cells, synced = 0, perf_counter()
+        f.flush()
+        fsync(f.fileno())
 
 
 def load_data(loading_config):
@@ -166,8 +298,17 @@ def get_domains(data_without_target, dataset_config):
         return {f:set(v) for f,v in data_without_target.to_dict('list').items()}
 
 
+def explainer_settings():
+    # every setting the explainers run with, the defaults they are not given included, goes into the key of a cell
+    parameters = signature(Explainer).parameters
+    settings = {name: parameter.default for name, parameter in parameters.items() if parameter.default is not parameter.empty}
+    settings.update(EXPLAINER_SETTINGS)
+    settings.pop('persistent_cache')
+    return settings
+
+
 def get_explainer(classifier, preparer, distribution, domains):
-    return Explainer(classifier, preparer, distribution, domains)
+    return Explainer(classifier, preparer, distribution, domains, **EXPLAINER_SETTINGS, persistent_cache=PERSISTENT_CACHE)
 
 
 
@@ -1,33 +1,183 @@
+from os import getpid
 from os.path import exists
+from sqlite3 import connect
 from time import perf_counter
 from pickle import dump, load
-from pandas import Series, read_csv
+from sys import getsizeof
+from collections import OrderedDict
+from pandas import read_csv
 
 
-def memoization(key_parameter={}):
-    memory = {}
+DEFAULT_CACHE_SIZE = 2**20
+DEFAULT_PERSISTENT_BATCH = 256
+MAX_QUERY_KEYS = 500
+
+
+class LRUCache:
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE, max_bytes=None):
+        self.entries = OrderedDict()
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    def lookup(self, key):
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return True, self.entries[key][0]
+        self.misses += 1
+        return False, None
+
+
+    def store(self, key, value):
+        if key in self.entries:
+            self.bytes -= self.entries.pop(key)[1]
+        size = approximate_size(key) + approximate_size(value) if self.max_bytes is not None else 0
+        self.entries[key] = (value, size)
+        self.bytes += size
+        while self.entries and ((self.max_size is not None and len(self.entries) > self.max_size) or (self.max_bytes is not None and self.bytes > self.max_bytes)):
+            self.bytes -= self.entries.popitem(last=False)[1][1]
+            self.evictions += 1
+
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+
+    def statistics(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'size': len(self.entries), 'bytes': self.bytes}
+
+
+def approximate_size(value):
+    if isinstance(value, (tuple, frozenset)):
+        return getsizeof(value) + sum(approximate_size(v) for v in value)
+    return getsizeof(value)
+
+
+class PersistentCache:
+    # sqlite table of memoized values shared by runs and processes, one row per fingerprint, function, fixed-feature
+    # bitmask and mixed-radix key, all of them integers; the rows read back stay in a bounded LRU
+    def __init__(self, path, fingerprint, features, batch_size=DEFAULT_PERSISTENT_BATCH, max_size=DEFAULT_CACHE_SIZE):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.bits = {feature: 1 << i for i, feature in enumerate(features)}
+        self.batch_size = batch_size
+        self.pending = {}
+        self.rows = LRUCache(max_size)
+        self.ids = {}
+        self.pid = None
+        self.hits = 0
+        self.misses = 0
+
+
+    def connection(self):
+        # a forked process opens its own connection and leaves the rows its parent queued to the parent
+        if self.pid != getpid():
+            self.pid = getpid()
+            self.pending = {}
+            self.database = connect(self.path, timeout=60)
+            self.database.execute('PRAGMA journal_mode=WAL')
+            self.database.execute('PRAGMA synchronous=NORMAL')
+            self.database.execute('CREATE TABLE IF NOT EXISTS names (id INTEGER PRIMARY KEY, name TEXT UNIQUE)')
+            self.database.execute('CREATE TABLE IF NOT EXISTS expectations (fingerprint INTEGER, function INTEGER, fixed INTEGER, key INTEGER, value REAL, '
+                                  'PRIMARY KEY (fingerprint, function, fixed, key)) WITHOUT ROWID')
+            self.database.commit()
+        return self.database
+
+
+    def name_id(self, name):
+        if name not in self.ids:
+            database = self.connection()
+            with database:
+                database.execute('INSERT OR IGNORE INTO names (name) VALUES (?)', (name,))
+            self.ids[name] = database.execute('SELECT id FROM names WHERE name = ?', (name,)).fetchone()[0]
+        return self.ids[name]
+
+
+    def scope(self, function, fixed_features):
+        return self.name_id(self.fingerprint), self.name_id(function), sum(self.bits[feature] for feature in fixed_features)
+
+
+    def lookup(self, function, fixed_features, key):
+        values, found = self.lookup_many(function, fixed_features, [key])
+        return found[0], values[0]
+
+
+    def lookup_many(self, function, fixed_features, keys):
+        scope = self.scope(function, fixed_features)
+        values, found, missing = [None]*len(keys), [False]*len(keys), {}
+        for i, key in enumerate(keys):
+            hit, value = self.rows.lookup(scope + (int(key),))
+            if hit:
+                values[i], found[i] = value, True
+            else:
+                missing.setdefault(int(key), []).append(i)
+        missing_keys = list(missing)
+        for start in range(0, len(missing_keys), MAX_QUERY_KEYS):
+            chunk = missing_keys[start:start+MAX_QUERY_KEYS]
+            query = f"SELECT key, value FROM expectations WHERE fingerprint = ? AND function = ? AND fixed = ? AND key IN ({','.join('?'*len(chunk))})"
+            for key, value in self.connection().execute(query, scope + tuple(chunk)):
+                self.rows.store(scope + (key,), value)
+                for i in missing[key]:
+                    values[i], found[i] = value, True
+        self.hits += sum(found)
+        self.misses += len(keys) - sum(found)
+        return values, found
+
+
+    def store(self, function, fixed_features, key, value):
+        # sampled estimates differ from run to run, so only deterministic values are kept
+        if getattr(value, 'standard_error', None) is not None:
+            return
+        self.store_many(function, fixed_features, [key], [value])
+
+
+    def store_many(self, function, fixed_features, keys, values):
+        scope = self.scope(function, fixed_features)
+        for key, value in zip(keys, values):
+            row = scope + (int(key),)
+            self.pending[row] = None if value is None else float(value)
+            self.rows.store(row, self.pending[row])
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+
+    def flush(self):
+        if self.pending and self.pid == getpid():
+            with self.database:
+                self.database.executemany('INSERT OR IGNORE INTO expectations VALUES (?, ?, ?, ?, ?)', [row + (value,) for row, value in self.pending.items()])
+            self.pending = {}
+
+
+    def statistics(self):
+        return {'hits': self.hits, 'misses': self.misses, 'pending': len(self.pending), 'rows': len(self.rows.entries)}
+
+
+def memoization(key, persistent=False):
     def memoize(function):
-        def use_memory(*args, **kwargs):
-            kwargs.update(zip(function.__code__.co_varnames, args))
-            key = []
-            for p in key_parameter:
-                parameter = args[p] if isinstance(p, int) else kwargs[p]
-                if isinstance(parameter, tuple):
-                    key.append(tuple(sorted(parameter)))
-                elif isinstance(parameter, list):
-                    key.append(tuple(sorted(parameter)))
-                elif isinstance(parameter, set):
-                    key.append(tuple(sorted(parameter)))
-                elif isinstance(parameter, dict):
-                    key.append(tuple(sorted(parameter.items())))
-                elif isinstance(parameter, Series):
-                    key.append(tuple(sorted(parameter.to_dict().items())))
-                else:
-                    key.append(parameter)
-            hashable = tuple(key)
-            if hashable not in memory:
-                memory[hashable] = function(**kwargs)
-            return memory[hashable]
+        def use_memory(self, *args, **kwargs):
+            caches = self.__dict__.setdefault('caches', {})
+            if function.__name__ not in caches:
+                caches[function.__name__] = LRUCache(**getattr(self, 'cache_limits', {}))
+            cache = caches[function.__name__]
+
+            hashable = key(self, *args, **kwargs)
+            found, value = cache.lookup(hashable)
+            if not found:
+                store = getattr(self, 'persistent_cache', None) if persistent else None
+                if store is not None:
+                    found, value = store.lookup(function.__name__, *hashable)
+                if not found:
+                    value = function(self, *args, **kwargs)
+                    if store is not None:
+                        store.store(function.__name__, *hashable, value)
+                cache.store(hashable, value)
+            return value
 
         return use_memory
     return memoize
@@ -0,0 +1,140 @@
+from numpy import log, pi, zeros, argmax, array_equal, float32, float64
+from sklearn.base import BaseEstimator
+from sklearn.naive_bayes import GaussianNB
+from sklearn.ensemble import RandomForestClassifier, ExtraTreesClassifier
+from sklearn.tree import DecisionTreeClassifier, ExtraTreeClassifier
+from sklearn.linear_model import LogisticRegression
+
+
+TREE_ESTIMATORS = (RandomForestClassifier, ExtraTreesClassifier, DecisionTreeClassifier, ExtraTreeClassifier)
+SPARSE_ESTIMATORS = TREE_ESTIMATORS + (LogisticRegression,)
+
+
+def get_backend(classifier, preparer, encoding):
+    try:
+        if isinstance(classifier, GaussianNB):
+            return GaussianNBBackend(classifier, preparer, encoding)
+    except ValueError:
+        pass
+    return None
+
+
+def get_tree_backend(classifier, preparer, encoding, aggregation):
+    try:
+        if isinstance(classifier, RandomForestClassifier):
+            return TreeEnsembleBackend(classifier, preparer, encoding, aggregation)
+    except ValueError:
+        pass
+    return None
+
+
+def accepts_compiled(classifier):
+    # only sklearn estimators are known to read their input positionally, anything else gets the preparer's own frame
+    return isinstance(classifier, BaseEstimator)
+
+
+def accepts_sparse(classifier):
+    return isinstance(classifier, SPARSE_ESTIMATORS)
+
+
+def sparse_input_type(classifier):
+    # trees compare in float32 anyway, handing them float32 saves sklearn a copy of the matrix
+    return float32 if isinstance(classifier, TREE_ESTIMATORS) else float64
+
+
+def verify_backend(backend, classifier, compiled, encoding, samples=256, seed=0):
+    # compiling already checked the gathered inputs against preprocess, so the classifier is fed those
+    codes = encoding.random_codes(samples, seed)
+    inputs = compiled.frame(codes) if hasattr(classifier, 'feature_names_in_') else compiled(codes)
+    if not array_equal(backend.predict(codes), classifier.predict(inputs)):
+        raise ValueError('The model backend disagrees with the classifier.')
+
+
+
+class GaussianNBBackend:
+    def __init__(self, classifier, preparer, encoding):
+        self.classes = classifier.classes_
+        means = classifier.theta_
+        variances = getattr(classifier, 'var_', None)
+        if variances is None:
+            variances = classifier.sigma_
+        compiled = preparer.compile(encoding)
+        blocks, constant_columns, constant_values = compiled.blocks, compiled.constant_columns, compiled.constant_values
+
+        self.constant = log(classifier.class_prior_) - 0.5*log(2*pi*variances).sum(axis=1)
+        self.constant -= 0.5*((constant_values - means[:, constant_columns])**2 / variances[:, constant_columns]).sum(axis=1)
+        self.tables = [-0.5*((values[:, None, :] - means[None, :, columns])**2 / variances[None, :, columns]).sum(axis=2) for columns, values in blocks]
+        verify_backend(self, classifier, compiled, encoding)
+
+
+    def joint_log_likelihood(self, codes):
+        likelihood = zeros((len(codes), len(self.classes))) + self.constant
+        for i, table in enumerate(self.tables):
+            likelihood += table[codes[:, i]]
+        return likelihood
+
+
+    def predict(self, codes):
+        return self.classes[argmax(self.joint_log_likelihood(codes), axis=1)]
+
+
+
+class TreeEnsembleBackend:
+    # expected value of the per-tree vote ('vote') or of the per-tree class probabilities ('proba') under a
+    # product-form distribution, averaged over the trees; the forest's own argmax over the averaged probabilities
+    # does not decompose over trees, so neither quantity is the expectation of predict in general
+    def __init__(self, classifier, preparer, encoding, aggregation='vote'):
+        if aggregation not in ('vote', 'proba'):
+            raise ValueError('Tree aggregation not defined.')
+        self.encoding = encoding
+        compiled = preparer.compile(encoding)
+        blocks, constant_columns, constant_values = compiled.blocks, compiled.constant_columns, compiled.constant_values
+        owners = {column: (i, values[:, k]) for i, (columns, values) in enumerate(blocks) for k, column in enumerate(columns)}
+        constants = dict(zip(constant_columns, constant_values))
+
+        self.trees = []
+        for estimator in classifier.estimators_:
+            tree = estimator.tree_
+            distributions = tree.value[:, 0, :] / tree.value[:, 0, :].sum(axis=1, keepdims=True)
+            leaf_values = classifier.classes_[argmax(distributions, axis=1)] if aggregation == 'vote' else distributions @ classifier.classes_
+            splits = {}
+            for node in range(tree.node_count):
+                if tree.children_left[node] == -1:
+                    continue
+                column, threshold = tree.feature[node], tree.threshold[node]
+                if column in owners:
+                    feature, inputs = owners[column]
+                    splits[node] = (feature, inputs <= threshold)
+                else:
+                    splits[node] = (None, constants[column] <= threshold)
+            self.trees.append((tree.children_left, tree.children_right, splits, leaf_values))
+
+
+    def expectation(self, codes, fixed_features, factors):
+        free = set(self.encoding.free(fixed_features))
+        masses = {i: factors[i] for i in free}
+        total_masses = {i: masses[i].sum() for i in free}
+        if any(total == 0 for total in total_masses.values()):
+            return None
+
+        expected_value = 0.0
+        for left, right, splits, leaf_values in self.trees:
+            stack = [(0, 1.0, {})]
+            while stack:
+                node, probability, allowed = stack.pop()
+                if node not in splits:
+                    expected_value += probability * leaf_values[node]
+                    continue
+                feature, goes_left = splits[node]
+                if feature is None:
+                    stack.append((left[node] if goes_left else right[node], probability, allowed))
+                elif feature not in free:
+                    stack.append((left[node] if goes_left[codes[feature]] else right[node], probability, allowed))
+                else:
+                    current = allowed.get(feature, masses[feature] > -1)
+                    current_mass = masses[feature][current].sum()
+                    for child, branch in ((left[node], current & goes_left), (right[node], current & ~goes_left)):
+                        branch_mass = masses[feature][branch].sum()
+                        if branch_mass > 0:
+                            stack.append((child, probability * branch_mass / current_mass, {**allowed, feature: branch}))
+        return expected_value / len(self.trees)
@@ -0,0 +1,129 @@
+from models import get_backend, accepts_compiled, accepts_sparse, sparse_input_type
+
+from numpy import empty, zeros, unique, searchsorted, minimum, insert, concatenate
+from warnings import catch_warnings, filterwarnings
+from weakref import WeakValueDictionary
+
+
+
+DEFAULT_MAX_ROWS = 2**24
+DEFAULT_BATCH_ROWS = 2**16
+# an oracle lives only as long as some explainer holds it, the registry just lets explainers of one model share it
+oracles = WeakValueDictionary()
+
+
+def get_oracle(classifier, preparer, encoding, max_rows=DEFAULT_MAX_ROWS, model_engine=True):
+    key = (id(classifier), id(preparer), encoding.signature, model_engine)
+    oracle = oracles.get(key)
+    if oracle is None:
+        oracle = oracles[key] = PredictionOracle(classifier, preparer, encoding, max_rows, model_engine)
+    return oracle
+
+
+def compile_preparer(preparer, encoding):
+    try:
+        return preparer.compile(encoding) if hasattr(preparer, 'compile') else None
+    except ValueError:
+        return None
+
+
+
+class PredictionOracle:
+    def __init__(self, classifier, preparer, encoding, max_rows=DEFAULT_MAX_ROWS, model_engine=True):
+        self.classifier = classifier
+        self.max_rows = max_rows
+        self.backend = get_backend(classifier, preparer, encoding) if model_engine else None
+        self.compiled = compile_preparer(preparer, encoding) if model_engine and self.backend is None and accepts_compiled(classifier) else None
+        self.sparse = self.compiled is not None and getattr(preparer, 'sparse', False) and accepts_sparse(classifier)
+        self.preparer = preparer
+        self.encoding = encoding
+        self.keys = empty(0, dtype=encoding.strides.dtype)
+        self.predictions = None
+        self.dense = None
+        self.model_calls = 0
+        self.predicted_rows = 0
+        self.pending = []
+        self.pending_rows = 0
+        self.batch_rows = DEFAULT_BATCH_ROWS
+
+
+    def __call__(self, codes):
+        if not self.pending:
+            return self.resolve(codes)
+        # a result is needed now, so the queued rows go to the model in the same batch
+        self.pending.append(codes)
+        predictions = self.flush()
+        return predictions[len(predictions)-len(codes):]
+
+
+    def submit(self, codes):
+        self.pending.append(codes)
+        self.pending_rows += len(codes)
+        if self.pending_rows >= self.batch_rows:
+            self.flush()
+
+
+    def flush(self):
+        codes = concatenate(self.pending)
+        self.pending, self.pending_rows = [], 0
+        return self.resolve(codes)
+
+
+    def resolve(self, codes):
+        keys = self.encoding.keys(codes)
+        positions, found = self.lookup(keys)
+        if not found.all():
+            unseen_keys, first, inverse = unique(keys[~found], return_index=True, return_inverse=True)
+            unseen_predictions = self.predict(codes[~found][first])
+            if self.max_rows is None or len(self.keys) + len(unseen_keys) <= self.max_rows:
+                self.store(unseen_keys, unseen_predictions)
+            else:
+                predictions = empty(len(keys), dtype=unseen_predictions.dtype)
+                if found.any():
+                    predictions[found] = self.predictions[positions[found]]
+                predictions[~found] = unseen_predictions[inverse]
+                return predictions
+            positions, found = self.lookup(keys)
+        return self.predictions[positions]
+
+
+    def tensor(self):
+        if self.dense is None:
+            self.dense = self(self.encoding.grid(zeros(len(self.encoding.features), dtype=self.encoding.dtype), ())).astype(float).reshape(self.encoding.sizes)
+        return self.dense
+
+
+    def predict(self, codes):
+        self.model_calls += 1
+        self.predicted_rows += len(codes)
+        if self.backend is not None:
+            return self.backend.predict(codes)
+        if self.sparse:
+            # the rows carry no column names, which the estimator fitted on a DataFrame warns about
+            with catch_warnings():
+                filterwarnings('ignore', message='X does not have valid feature names')
+                return self.classifier.predict(self.compiled.sparse(codes, sparse_input_type(self.classifier)))
+        # estimators that need dense input see at most batch_rows dense rows at a time
+        return concatenate([self.predict_dense(codes[start:start+self.batch_rows]) for start in range(0, len(codes), self.batch_rows)])
+
+
+    def predict_dense(self, codes):
+        if self.compiled is not None:
+            return self.classifier.predict(self.compiled.frame(codes) if hasattr(self.classifier, 'feature_names_in_') else self.compiled(codes))
+        return self.classifier.predict(self.preparer.preprocess(self.encoding.decode(codes)))
+
+
+    def lookup(self, keys):
+        if len(self.keys) == 0:
+            return zeros(len(keys), dtype=int), zeros(len(keys), dtype=bool)
+        positions = minimum(searchsorted(self.keys, keys), len(self.keys)-1)
+        return positions, self.keys[positions] == keys
+
+
+    def store(self, keys, predictions):
+        if self.predictions is None:
+            self.keys, self.predictions = keys, predictions
+            return
+        positions = searchsorted(self.keys, keys)
+        self.keys = insert(self.keys, positions, keys)
+        self.predictions = insert(self.predictions, positions, predictions)
@@ -0,0 +1,177 @@
+from itertools import combinations
+from multiprocessing import get_context, get_all_start_methods
+from multiprocessing.shared_memory import SharedMemory
+from concurrent.futures import ProcessPoolExecutor
+from weakref import finalize
+from math import prod
+from numpy import ndarray, int64, uint64, float64, zeros, unique, flatnonzero
+
+
+
+DEFAULT_SHARED_SLOTS = 2**20
+MAX_LOAD = 0.7
+MAX_PROBES = 64
+worker_state = {}
+
+
+def supports_parallel_search(encoding):
+    # the expected values of all features share one table, keyed on the projection and the freed feature's position
+    return 'fork' in get_all_start_methods() and encoding.strides.dtype == int64 and prod(encoding.sizes.tolist()) * len(encoding.features) < 2**63
+
+
+
+class SharedTable:
+    # open addressing hash table from non-negative int64 keys to float64 values in shared memory, -1 marks a free slot
+    def __init__(self, capacity, lock, name=None):
+        self.capacity = max(2, 1 << (int(capacity)-1).bit_length())
+        self.shift = uint64(64 - self.capacity.bit_length() + 1)
+        self.lock = lock
+        self.memory = SharedMemory(name=name, create=name is None, size=16*self.capacity+8)
+        self.keys = ndarray(self.capacity, dtype=int64, buffer=self.memory.buf)
+        self.values = ndarray(self.capacity, dtype=float64, buffer=self.memory.buf, offset=8*self.capacity)
+        self.size = ndarray(1, dtype=int64, buffer=self.memory.buf, offset=16*self.capacity)
+        if name is None:
+            self.keys[:] = -1
+            self.size[0] = 0
+
+
+    def handle(self):
+        return self.capacity, self.lock, self.memory.name
+
+
+    def slots(self, keys, probe):
+        return (((keys.astype(uint64) * uint64(0x9E3779B97F4A7C15)) >> self.shift).astype(int64) + probe) & (self.capacity-1)
+
+
+    def lookup(self, keys):
+        values, found = zeros(len(keys)), zeros(len(keys), dtype=bool)
+        pending = flatnonzero(keys >= 0)
+        for probe in range(MAX_PROBES):
+            if len(pending) == 0:
+                break
+            slots = self.slots(keys[pending], probe)
+            stored = self.keys[slots]
+            hits = stored == keys[pending]
+            values[pending[hits]] = self.values[slots[hits]]
+            found[pending[hits]] = True
+            pending = pending[~hits & (stored != -1)]
+        return values, found
+
+
+    def insert(self, keys, values):
+        keys, first = unique(keys, return_index=True)
+        values = values[first]
+        with self.lock:
+            pending = flatnonzero(keys >= 0)
+            for probe in range(MAX_PROBES):
+                if len(pending) == 0 or self.size[0] > MAX_LOAD*self.capacity:
+                    break
+                slots = self.slots(keys[pending], probe)
+                stored = self.keys[slots]
+                free = flatnonzero(stored == -1)
+                free = free[unique(slots[free], return_index=True)[1]]
+                # the value goes in before the key, so a reader never sees a key without its value
+                self.values[slots[free]] = values[pending[free]]
+                self.keys[slots[free]] = keys[pending[free]]
+                self.size[0] += len(free)
+                written = zeros(len(pending), dtype=bool)
+                written[free] = True
+                pending = pending[~written & (stored != keys[pending])]
+
+
+    def close(self, unlink=False):
+        del self.keys, self.values, self.size
+        self.memory.close()
+        if unlink:
+            self.memory.unlink()
+
+
+
+class SharedPredictions:
+    def __init__(self, oracle, encoding, table):
+        self.oracle = oracle
+        self.encoding = encoding
+        self.table = table
+
+
+    def __call__(self, codes):
+        keys = self.encoding.keys(codes)
+        predictions, found = self.table.lookup(keys)
+        if not found.all():
+            predictions[~found] = self.oracle(codes[~found])
+            self.table.insert(keys[~found], predictions[~found])
+        return predictions
+
+
+    def submit(self, codes):
+        self.oracle.submit(codes)
+
+
+
+class ParallelSearch:
+    # one pool and one pair of shared tables per explainer, so what the workers cached carries over to later calls
+    def __init__(self, explainer, workers, slots=DEFAULT_SHARED_SLOTS):
+        context = get_context('fork')
+        self.workers = workers
+        self.tables = [SharedTable(slots, context.Lock()) for _ in range(2)]
+        self.stop = context.Event()
+        self.executor = ProcessPoolExecutor(workers, mp_context=context, initializer=initialize_worker,
+                                            initargs=(explainer, [table.handle() for table in self.tables], self.stop))
+        self.finalizer = finalize(self, close_search, self.executor, self.tables)
+
+
+    def close(self):
+        self.finalizer()
+
+
+
+def close_search(executor, tables):
+    executor.shutdown()
+    for table in tables:
+        table.close(unlink=True)
+
+
+def parallel_x_resp(explainer, entity, feature, max_size, workers):
+    # every level of the size-ordered search is spread over the workers, a level ends early once some worker has
+    # reached the highest possible counter, which leaves its maximum (and so the result) the same as sequentially
+    if explainer.parallel_search is None or explainer.parallel_search.workers != workers:
+        explainer.close()
+        explainer.parallel_search = ParallelSearch(explainer, workers)
+    search = explainer.parallel_search
+
+    entity = explainer.encoding.encode(entity)
+    entity_prediction = explainer.prediction(entity)
+    highest_counter = explainer.highest_counter(entity_prediction)
+    candidates = list(set(explainer.encoding.features)-{feature})
+    max_size = len(candidates) if max_size is None else max_size-1
+
+    for size in range(max_size+1):
+        search.stop.clear()
+        contingency_sets = list(combinations(candidates, size))
+        chunks = [contingency_sets[i::4*workers] for i in range(min(len(contingency_sets), 4*workers))]
+        tasks = [search.executor.submit(search_contingency_sets, entity, chunk, feature, entity_prediction, highest_counter) for chunk in chunks]
+        best_counter = max([0] + [task.result() for task in tasks])
+        if best_counter > 0:
+            return 1/(1+size), best_counter
+    return 0.0, 0.0
+
+
+def initialize_worker(explainer, handles, stop):
+    predictions, expectations = [SharedTable(capacity, lock, name) for capacity, lock, name in handles]
+    explainer.oracle = SharedPredictions(explainer.oracle, explainer.encoding, predictions)
+    explainer.expectation_table = expectations
+    worker_state['explainer'] = explainer
+    worker_state['stop'] = stop
+
+
+def search_contingency_sets(entity, contingency_sets, feature, entity_prediction, highest_counter):
+    explainer, stop = worker_state['explainer'], worker_state['stop']
+    best_counter = 0
+    for contingency_set in contingency_sets:
+        if stop.is_set():
+            break
+        best_counter = max(best_counter, explainer.contingency_counter(entity, contingency_set, feature, entity_prediction)[0])
+        if best_counter >= highest_counter:
+            stop.set()
+            break
+    return best_counter
@@ -0,0 +1,40 @@
+from math import sqrt
+from statistics import NormalDist
+
+
+
+class Estimate(float):
+    def __new__(cls, value, standard_error=0.0, samples=0):
+        estimate = super().__new__(cls, value)
+        estimate.standard_error = standard_error
+        estimate.samples = samples
+        return estimate
+
+    def __reduce__(self):
+        return (Estimate, (float(self), self.standard_error, self.samples))
+
+
+def monte_carlo(draw, evaluate, tolerance=0.01, confidence=0.95, budget=100000, batch_size=1000):
+    z = NormalDist().inv_cdf((1+confidence)/2)
+    samples, total, total_squares = 0, 0.0, 0.0
+    while samples < budget:
+        batch = draw(min(batch_size, budget-samples))
+        if len(batch) == 0:
+            return None
+        values = evaluate(batch)
+        samples += len(values)
+        total += values.sum()
+        total_squares += (values**2).sum()
+
+        mean = total / samples
+        variance = max(total_squares/samples - mean**2, 0) * samples/(samples-1) if samples > 1 else 0
+        standard_error = sqrt(variance / samples)
+        if samples >= batch_size and z*standard_error <= tolerance:
+            break
+    return Estimate(mean, standard_error, samples)
+
+
+def difference(value, expected_value):
+    if isinstance(expected_value, Estimate):
+        return Estimate(value - expected_value, expected_value.standard_error, expected_value.samples)
+    return value - expected_value
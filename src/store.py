@@ -0,0 +1,95 @@
+from json import dump, load
+from os import makedirs
+from os.path import join, exists
+from numpy import array, memmap, dtype, int64, float64, nan, isnan
+from pandas import DataFrame
+
+
+
+DEFAULT_BUFFER_ROWS = 2**16
+COLUMNS = {'entity': int64, 'feature_set': int64, 'value': float64, 'counter': float64, 'runtime': float64}
+
+
+
+class ResultStore:
+    # one raw binary file per column that is only ever appended to, next to a meta.json with the feature sets
+    def __init__(self, path, features=None, feature_sets=None, mode='w', buffer_rows=DEFAULT_BUFFER_ROWS):
+        self.path = path
+        self.buffer_rows = buffer_rows
+        if mode == 'w' or not exists(join(path, 'meta.json')):
+            makedirs(path, exist_ok=True)
+            self.meta = {'features': list(features), 'feature_sets': [list(feature_set) for feature_set in feature_sets],
+                         'columns': {name: dtype(column_type).str for name, column_type in COLUMNS.items()}}
+            with open(join(path, 'meta.json'), 'w') as f:
+                dump(self.meta, f)
+            for name in COLUMNS:
+                open(join(path, f"{name}.bin"), 'wb').close()
+        else:
+            self.meta = read_meta(path)
+        self.buffer = {name: [] for name in COLUMNS}
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exception):
+        self.flush()
+
+
+    def append(self, entity, scores, runtime):
+        for feature_set, score in enumerate(scores):
+            # a Responsibility from the approximate searches also carries its optimal flag and evaluations
+            value, counter = score[:2] if isinstance(score, tuple) else (score, nan)
+            self.buffer['entity'].append(entity)
+            self.buffer['feature_set'].append(feature_set)
+            self.buffer['value'].append(float(value))
+            self.buffer['counter'].append(float(counter))
+            self.buffer['runtime'].append(runtime)
+        if len(self.buffer['entity']) >= self.buffer_rows:
+            self.flush()
+
+
+    def flush(self):
+        if not self.buffer['entity']:
+            return
+        for name, column_type in COLUMNS.items():
+            with open(join(self.path, f"{name}.bin"), 'ab') as f:
+                f.write(array(self.buffer[name], dtype=column_type).tobytes())
+            self.buffer[name] = []
+
+
+
+def read_meta(path):
+    with open(join(path, 'meta.json')) as f:
+        return load(f)
+
+
+def read_columns(path):
+    meta = read_meta(path)
+    columns = {}
+    for name, column_type in meta['columns'].items():
+        try:
+            columns[name] = memmap(join(path, f"{name}.bin"), dtype=column_type, mode='r')
+        except ValueError:
+            columns[name] = array([], dtype=column_type)
+    return meta, columns
+
+
+def read_results(path):
+    meta, columns = read_columns(path)
+    frame = DataFrame(columns, copy=False)
+    frame['feature_set'] = [tuple(meta['feature_sets'][i]) for i in frame['feature_set']]
+    return frame
+
+
+def export_dat(path, dat_file):
+    # the space separated layout main always wrote: one line per entity, the scores in feature set order, then the runtime
+    meta, columns = read_columns(path)
+    with open(dat_file, 'w') as f:
+        f.write(' '.join('_'.join(feature_set) for feature_set in meta['feature_sets'])+" Runtime\n")
+        size = len(meta['feature_sets'])
+        for start in range(0, len(columns['entity']), size):
+            values, counters = columns['value'][start:start+size], columns['counter'][start:start+size]
+            scores = [str(value) if isnan(counter) else str((value, counter)) for value, counter in zip(values.tolist(), counters.tolist())]
+            f.write(' '.join(scores) + f" {columns['runtime'][start]:.8f}\n")
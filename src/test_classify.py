@@ -0,0 +1,51 @@
+from copy import deepcopy
+
+import pytest
+from numpy import array_equal
+from pandas import DataFrame
+
+from classify import Preparer
+from constants import dataset_configurations, classifier_configurations
+from encoding import Encoding
+from main import load_data, get_domains
+from oracle import PredictionOracle
+
+
+
+DATASETS = ['blood-transfusion-service-center', 'german_credit_data', 'creditworthiness']
+
+
+def fitted_preparer(dataset, sparse):
+    dataset_config = deepcopy(dataset_configurations[dataset])
+    data = load_data(dataset_config['load'])
+    preparer = Preparer(**dataset_config['preprocessing'], sparse=sparse)
+    preparer.preprocess(data)
+    data = data.drop(columns=dataset_config['preprocessing']['drop'], errors='ignore')
+    data = data.drop(columns=dataset_config['split']['target'], errors='ignore')
+    return preparer, Encoding(get_domains(data, dataset_config))
+
+
+@pytest.mark.parametrize('sparse', [False, True])
+@pytest.mark.parametrize('dataset', DATASETS)
+def test_compiled_preparer_matches_preprocess(dataset, sparse):
+    preparer, encoding = fitted_preparer(dataset, sparse)
+    compiled = preparer.compile(encoding)
+    codes = encoding.random_codes(1024)
+    expected = preparer.preprocess(encoding.decode(codes))
+
+    assert array_equal(compiled(codes), expected.to_numpy(dtype=float), equal_nan=True)
+    frame = compiled.frame(codes)
+    assert list(frame.columns) == list(expected.columns)
+    assert array_equal(frame.to_numpy(dtype=float), expected.to_numpy(dtype=float), equal_nan=True)
+    assert array_equal(compiled.sparse(codes).toarray(), expected.to_numpy(dtype=float), equal_nan=True)
+
+
+def test_oracle_keeps_column_names_for_other_classifiers():
+    classifier = classifier_configurations['fake_classifier']['trained_classifier']
+    preparer = Preparer()
+    preparer.preprocess(DataFrame())
+    encoding = Encoding(dataset_configurations['fake']['load']['domains'])
+    codes = encoding.random_codes(1024)
+
+    oracle = PredictionOracle(classifier, preparer, encoding)
+    assert array_equal(oracle(codes), classifier.predict(preparer.preprocess(encoding.decode(codes))))
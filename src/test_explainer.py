@@ -0,0 +1,54 @@
+from itertools import product
+
+import pytest
+from numpy.random import default_rng
+from pandas import DataFrame, Series
+
+from classify import Preparer
+from constants import dataset_configurations, classifier_configurations
+from distributions import get_distribution
+from Explainer import Explainer
+
+
+
+DOMAINS = dataset_configurations['fake']['load']['domains']
+
+
+def fake_setup():
+    rng = default_rng(0)
+    data = DataFrame({feature: rng.choice(values, 40) for feature, values in DOMAINS.items()})
+    preparer = Preparer()
+    preparer.preprocess(DataFrame())
+    return classifier_configurations['fake_classifier']['trained_classifier'], preparer, data
+
+
+@pytest.mark.parametrize('distribution_name', ['uniform', 'fully_factorized', 'experimental'])
+def test_row_callable_matches_compiled_weights(distribution_name):
+    classifier, preparer, data = fake_setup()
+    distribution = get_distribution(distribution_name, data)
+    compiled = Explainer(classifier, preparer, distribution, DOMAINS)
+    # a user-supplied distribution has no compile, so the explainer asks it row by row
+    by_row = Explainer(classifier, preparer, lambda entity, fixed_features: distribution(entity, fixed_features), DOMAINS)
+    assert by_row.weights is None
+
+    for values in product(*DOMAINS.values()):
+        entity = Series(dict(zip(DOMAINS, values)))
+        for feature in DOMAINS:
+            assert by_row.counter(entity, feature) == pytest.approx(compiled.counter(entity, feature))
+
+
+def test_explain_batch_scores_feature_groups():
+    classifier, preparer, data = fake_setup()
+    explainer = Explainer(classifier, preparer, get_distribution('fully_factorized', data), DOMAINS)
+    entities = data.head(5)
+    features = ['A', ('A', 'B'), ('C',)]
+    scores = explainer.explain_batch(entities, features, scores=('counter', 'shap'))
+
+    for label, entity in entities.iterrows():
+        for feature, group in zip(features, [{'A'}, {'A', 'B'}, {'C'}]):
+            rows = scores[(scores['entity'] == label) & (scores['feature'] == feature)].set_index('score')['value']
+            assert rows['counter'] == pytest.approx(explainer.counter_plus(entity, group))
+            assert rows['shap'] == pytest.approx(explainer.shap_plus(entity, group))
+
+    with pytest.raises(Exception, match='not defined for feature groups'):
+        explainer.explain_batch(entities, features, scores=('x_resp',))